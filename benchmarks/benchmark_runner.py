@@ -2,15 +2,22 @@
 from __future__ import annotations
 
 import asyncio
+import copy
+import functools
 import importlib.util
 import json
+import math
 import os
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
-from typing import List
+from types import ModuleType
+from typing import Iterator, List, TextIO
 from uuid import uuid4
 
+import attr
 from openai.types.chat.completion_create_params import ResponseFormat
 from spice import SpiceMessage
 from spice.spice import get_model_from_name
@@ -27,20 +34,73 @@ from mentat.sampler.sample import Sample
 from mentat.sampler.utils import setup_repo
 from mentat.session_context import SESSION_CONTEXT
 
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore
+
+_SANITIZE_RE = re.compile(r"[ '\"/\\^-]")
+
+# Benchmarks for the same repo share one clone, so those loaded in parallel must take turns checking it out
+_setup_repo_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=256)
+def _cached_comparison_diff(
+    repo_url: str, merge_base: str | None, diff_merge_base: str, diff_active: str, comparison_commit: str
+) -> str:
+    with _setup_repo_lock:
+        repo = setup_repo(
+            url=repo_url,
+            cwd=None,
+            commit=merge_base,
+            diff_merge_base=diff_merge_base,
+            diff_active=diff_active,
+            chdir=False,
+            required_commits=[comparison_commit],
+        )
+        return get_git_diff("HEAD", comparison_commit, cwd=Path(repo.working_dir))
+
 
 def git_diff_from_comparison_commit(sample: Sample, comparison_commit: str) -> str:
-    starting_cwd = Path.cwd()
-    repo = setup_repo(
-        url=sample.repo,
-        cwd=None,
-        commit=sample.merge_base,
-        diff_merge_base=sample.diff_merge_base,
-        diff_active=sample.diff_active,
+    # Benchmarks sharing a repo and commits would otherwise redo the same clone and checkout
+    return _cached_comparison_diff(
+        sample.repo,
+        sample.merge_base,
+        sample.diff_merge_base,
+        sample.diff_active,
+        comparison_commit,
     )
-    cwd = Path(repo.working_dir)
-    diff = get_git_diff("HEAD", comparison_commit, cwd=cwd)
-    os.chdir(starting_cwd)
-    return diff
+
+
+@functools.lru_cache(maxsize=None)
+def _load_module_cached(path_to_module: str, mtime_ns: int, module_name: str) -> ModuleType:
+    # mtime_ns is only part of the cache key, so edited modules are re-imported
+    spec = importlib.util.spec_from_file_location(module_name, path_to_module)
+    assert spec and spec.loader
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _copy_config(config: Config) -> Config:
+    # Sessions mutate their Config (e.g. maximum_context, sampler), so cached modules hand out copies.
+    # attr.evolve would re-run the parser converter; parsers are shared parser_map instances anyway.
+    config = copy.copy(config)
+    for field in attr.fields(Config):
+        value = getattr(config, field.name)
+        if isinstance(value, list):
+            setattr(config, field.name, list(value))
+    return config
+
+
+# Generous upper bound on the tokens count_prompt_tokens adds for the two messages' framing
+_MESSAGE_TOKEN_OVERHEAD = 32
+
+
+@functools.lru_cache(maxsize=32)
+def _max_grade_tokens(model: str) -> int:
+    return get_model_from_name(model).context_length - 1000  # Response buffer
 
 
 async def grade(to_grade, prompt, model="gpt-4-1106-preview"):
@@ -50,18 +110,24 @@ async def grade(to_grade, prompt, model="gpt-4-1106-preview"):
             {"role": "system", "content": prompt},
             {"role": "user", "content": to_grade},
         ]
-        tokens = llm_api_handler.spice.count_prompt_tokens(messages, model)
-        max_tokens = get_model_from_name(model).context_length - 1000  # Response buffer
-        if tokens > max_tokens:
-            print("Prompt too long! Truncating... (this may affect results)")
-            tokens_to_remove = tokens - max_tokens
-            chars_per_token = len(str(messages)) / tokens
-            chars_to_remove = int(chars_per_token * tokens_to_remove)
-            messages[1]["content"] = messages[1]["content"][:-chars_to_remove]
+        max_tokens = _max_grade_tokens(model)
+        # Byte-level BPE tokens each cover at least one UTF-8 byte, so a prompt with fewer bytes
+        # (plus per-message overhead) than max_tokens can't be too long and needn't be tokenized
+        prompt_bytes = len(prompt.encode()) + len(to_grade.encode())
+        if prompt_bytes + _MESSAGE_TOKEN_OVERHEAD >= max_tokens:
+            tokens = llm_api_handler.spice.count_prompt_tokens(messages, model)
+            if tokens > max_tokens:
+                print("Prompt too long! Truncating... (this may affect results)")
+                tokens_to_remove = tokens - max_tokens
+                # str(messages) includes the repr overhead, erring towards removing slightly too much
+                chars_per_token = len(str(messages)) / tokens
+                chars_to_remove = max(1, math.ceil(chars_per_token * tokens_to_remove))
+                to_truncate = messages[1]["content"]
+                messages[1]["content"] = to_truncate[: max(0, len(to_truncate) - chars_to_remove)]
 
         llm_grade = await llm_api_handler.call_llm_api(messages, model, None, False, ResponseFormat(type="json_object"))
         content = llm_grade.text
-        return json.loads(content)
+        return orjson.loads(content) if orjson is not None else json.loads(content)
     except Exception as e:
         return {"error": str(e)}
 
@@ -106,6 +172,8 @@ with a clause like "Please note I may not have had all the information I needed"
 
 
 async def grade_model_response(model_response):
+    if not model_response.strip():
+        return {}
     return await grade(model_response, model_response_grade_prompt)
 
 
@@ -127,21 +195,73 @@ async def compare_diffs(actual, generated):
     return await grade(prompt, comparison_prompt)
 
 
+combined_grading_prompt = f"""\
+You will be given up to three sections, each starting with a header line:
+"=== MODEL RESPONSE ===" (optional), "=== HUMAN WRITTEN DIFF ===" (optional) and
+"=== DIFF ===". Grade each section independently and reply with a single json
+object with the following fields:
+response: only present if there is a MODEL RESPONSE section. A json object
+grading the MODEL RESPONSE section, as described below under MODEL RESPONSE.
+diff: a json object grading the DIFF section, as described below under DIFF.
+comparison: only present if there is a HUMAN WRITTEN DIFF section. A json object
+comparing the DIFF section (automated) to the HUMAN WRITTEN DIFF section, as
+described below under COMPARISON.
+
+MODEL RESPONSE:
+{model_response_grade_prompt}
+
+DIFF:
+{syntax_grading_prompt}
+
+COMPARISON:
+{comparison_prompt}"""
+
+
+async def grade_combined(diff, response, comparison_diff=None):
+    # An empty response gets an empty grade, as in grade_model_response
+    has_response = bool(response.strip())
+    sections = [f"=== MODEL RESPONSE ===\n{response}"] if has_response else []
+    if comparison_diff:
+        sections.append(f"=== HUMAN WRITTEN DIFF ===\n{comparison_diff}")
+    # The diff goes last, since it is what gets truncated if the prompt is too long
+    sections.append(f"=== DIFF ===\n{diff}")
+    combined_grade = await grade("\n".join(sections), combined_grading_prompt)
+    if not isinstance(combined_grade, dict):
+        combined_grade = {"error": f"Expected a json object, got: {combined_grade}"}
+
+    def _section(key):
+        section = combined_grade.get(key)
+        if isinstance(section, dict):
+            return section
+        return {"error": combined_grade.get("error", f"Missing {key} grade")}
+
+    return (
+        _section("diff"),
+        _section("response") if has_response else {},
+        _section("comparison") if comparison_diff else None,
+    )
+
+
 async def grade_diff(diff, response, result, comparison_diff=None):
+    # Nothing to grade, e.g. the model made no edits or the sample failed early
+    if not diff.strip():
+        result.code = diff
+        return result
+
+    # A single call grades everything, so the system prompt and round trip are only paid once
+    diff_grade, response_grade, comparison_grade = await grade_combined(diff, response, comparison_diff)
+
     # Set syntax and response grade information
     result.code = diff
-    diff_grade = await grade_diff_syntax(diff)
     result.diff_grade = diff_grade
     result.off_by_one = diff_grade.get("off_by_one")
     result.indentation_error = diff_grade.get("indentation")
     result.syntax_error = diff_grade.get("syntax")
-    response_grade = await grade_model_response(response)
     result.response_grade = response_grade
     result.referenced_format = response_grade.get("referenced_format")
 
     # Set comparison grade information
-    if comparison_diff:
-        comparison_grade = await compare_diffs(diff, comparison_diff)
+    if comparison_grade is not None:
         result.comparison_grade = comparison_grade
         result.extra_functionality = comparison_grade.get("extra_functionality")
         result.missing_functionality = comparison_grade.get("missing_functionality")
@@ -149,6 +269,10 @@ async def grade_diff(diff, response, result, comparison_diff=None):
     return result
 
 
+def _sanitize(s: str) -> str:
+    return _SANITIZE_RE.sub("", s)
+
+
 class Benchmark:
     def __init__(
         self,
@@ -166,16 +290,13 @@ class Benchmark:
 
     @classmethod
     def from_module(cls, path_to_module: Path, module_name: str) -> Benchmark:
-        # Dynamic import
-        spec = importlib.util.spec_from_file_location(module_name, path_to_module)
-        assert spec and spec.loader
-        module = importlib.util.module_from_spec(spec)
-        spec.loader.exec_module(module)
+        # Dynamic import; the module is cached, so Samples and Config are created per call
+        module = _load_module_cached(str(path_to_module), path_to_module.stat().st_mtime_ns, module_name)
 
         output = cls(
             title=module.title,
             description=module.description,
-            config=module.config,
+            config=_copy_config(module.config),
             verify=module.verify if hasattr(module, "verify") else None,
             samples=[
                 # Create new samples for each prompt
@@ -214,32 +335,47 @@ class Benchmark:
             samples=[sample],
         )
 
-    async def run(self, retries: int = 1) -> list[BenchmarkResult]:
+    async def run(
+        self, retries: int = 1, max_concurrency: int = 8, cwd_lock: asyncio.Lock | None = None
+    ) -> list[BenchmarkResult]:
         print("Benchmark:", self.title)
-        start_dir = Path.cwd()
-        results: list[BenchmarkResult] = []
-        for i, sample in enumerate(self.samples):
-            print("  Prompt:", sample.message_prompt)
-            for j in range(1, retries + 1):
-                formatted_title = re.sub(r"[ '\"/\\-^]", "", sample.title).replace(" ", "_")
-                result = BenchmarkResult(
-                    name=f"{formatted_title}-{i}-{j}",
-                    family=formatted_title,
-                )
+        semaphore = asyncio.Semaphore(max_concurrency)
+        # Samples share a cloned repo and the process-wide cwd, so only grading can overlap
+        cwd_lock = cwd_lock or asyncio.Lock()
+
+        async def _run_one(sample: Sample, formatted_title: str, i: int, j: int) -> BenchmarkResult:
+            result = BenchmarkResult(
+                name=f"{formatted_title}-{i}-{j}",
+                family=formatted_title,
+            )
+            async with semaphore:
                 try:
-                    if sample.context and self.config.auto_context_tokens:
-                        score = await run_auto_context_benchmark(sample, self.config)
-                        result.context_results = {**score, "auto_context_tokens": self.config.auto_context_tokens}
-                        result.context_precision = score["precision"]
-                        result.context_recall = score["recall"]
-                    sample_result = await run_sample(sample, config=self.config)
-                    result.cost = sample_result["cost"]
-                    result.tokens = sample_result["tokens"]
-                    result.transcript = sample_result["transcript"]
-                    result.test_eval_results = sample_result["test_eval_results"]
-                    result.test_eval_passed = sample_result["test_eval_passed"]
-                    if self.verify is not None:
-                        result.verify = self.verify()
+                    async with cwd_lock:
+                        # Read inside the lock, since holders only restore the cwd on release
+                        start_dir = Path.cwd()
+                        try:
+                            if j == 1:
+                                print("  Prompt:", sample.message_prompt)
+                            # Not overlapped with run_sample: both check out the same clone, the daemon
+                            # would index the model's edits, and its cleanup resets the cwd mid-session
+                            if sample.context and self.config.auto_context_tokens:
+                                score = await run_auto_context_benchmark(sample, self.config)
+                                result.context_results = {
+                                    **score,
+                                    "auto_context_tokens": self.config.auto_context_tokens,
+                                }
+                                result.context_precision = score["precision"]
+                                result.context_recall = score["recall"]
+                            sample_result = await run_sample(sample, config=self.config)
+                            result.cost = sample_result["cost"]
+                            result.tokens = sample_result["tokens"]
+                            result.transcript = sample_result["transcript"]
+                            result.test_eval_results = sample_result["test_eval_results"]
+                            result.test_eval_passed = sample_result["test_eval_passed"]
+                            if self.verify is not None:
+                                result.verify = self.verify()
+                        finally:
+                            os.chdir(start_dir)
 
                     await grade_diff(
                         sample_result["diff_eval"],
@@ -249,10 +385,42 @@ class Benchmark:
                     )
                 except Exception as e:
                     result.run_error = str(e)
-                finally:
-                    results.append(result)
-                    os.chdir(start_dir)
-        return results
+            return result
+
+        formatted_titles = [_sanitize(sample.title) for sample in self.samples]
+        # gather preserves the order of the (sample, retry) pairs
+        return list(
+            await asyncio.gather(
+                *(
+                    _run_one(sample, formatted_title, i, j)
+                    for i, (sample, formatted_title) in enumerate(zip(self.samples, formatted_titles))
+                    for j in range(1, retries + 1)
+                )
+            )
+        )
+
+
+def _skip_dir(name: str) -> bool:
+    return name.startswith(".") or name in {"__pycache__", "node_modules"}
+
+
+def _iter_files(root: str | Path) -> Iterator[os.DirEntry[str]]:
+    # scandir entries cache their type from the directory listing, saving a stat per file.
+    # Like os.walk, unreadable directories are skipped and files come before subdirectories.
+    try:
+        with os.scandir(root) as it:
+            entries = list(it)
+    except OSError:
+        return
+    subdirs = list[str]()
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            if not _skip_dir(entry.name):
+                subdirs.append(entry.path)
+        elif entry.is_file():
+            yield entry
+    for subdir in subdirs:
+        yield from _iter_files(subdir)
 
 
 def benchmark_listed(title, benchmarks):
@@ -262,63 +430,93 @@ def benchmark_listed(title, benchmarks):
     return False
 
 
+def _result_json(result: BenchmarkResult) -> str:
+    # orjson is much faster on the nested grade dicts; to_json stays stdlib for callers
+    if orjson is None:
+        return result.to_json()
+    return orjson.dumps(result.to_dict(), option=orjson.OPT_NON_STR_KEYS).decode()
+
+
+async def _run_benchmarks_concurrently(
+    benchmarks: list[Benchmark],
+    retries: int,
+    max_workers: int,
+    results_file: TextIO,
+    all_results: list[BenchmarkResult],
+) -> None:
+    semaphore = asyncio.Semaphore(max_workers)
+    # Shared by every benchmark, since they may clone into the same directory
+    cwd_lock = asyncio.Lock()
+
+    async def _run_one(benchmark: Benchmark):
+        async with semaphore:
+            try:
+                result = await benchmark.run(retries=retries, cwd_lock=cwd_lock)
+            except Exception as e:
+                print(f"Error running benchmark {benchmark.title}: {e}")
+                return
+        try:
+            all_results.extend(result)
+            # Plain blocking writes, so results from different benchmarks never interleave
+            for r in result:
+                results_file.write(_result_json(r) + "\n")
+            # Flush per benchmark so the cache survives a crash
+            results_file.flush()
+        except Exception as e:
+            print(f"Error saving results for benchmark {benchmark.title}: {e}")
+
+    await asyncio.gather(*(_run_one(benchmark) for benchmark in benchmarks))
+
+
 def run_benchmarks(
     user_benchmarks: list[str],
     directory: str,
     retries: int = 1,
     max_benchmarks: int | None = None,
     auto_context_tokens: int = 0,
+    max_workers: int = 1,
 ):
     # Load benchmarks
     dir_path = Path(directory).resolve()
     assert dir_path.exists(), f"Invalid directory: {directory}"
     print(f"Running benchmarks from {dir_path}")
-    benchmarks: list[Benchmark] = []
-    for root, dirs, files in os.walk(dir_path):
-        for file in files:
-            path = Path(root) / file
-            if file.endswith(".py"):
-                benchmark = Benchmark.from_module(path, "benchmark")
-            elif file.endswith(".json"):
-                config = Config(auto_context_tokens=auto_context_tokens)
-                benchmark = Benchmark.from_sample(path, config)
-            else:
-                continue
-
-            if len(user_benchmarks) > 0 and not benchmark_listed(benchmark.title, user_benchmarks):
-                continue
-            benchmarks.append(benchmark)
+    entries = [Path(entry.path) for entry in _iter_files(dir_path) if entry.name.endswith((".py", ".json"))]
+
+    def _load_one(path: Path) -> Benchmark:
+        if path.suffix == ".py":
+            return Benchmark.from_module(path, "benchmark")
+        config = Config(auto_context_tokens=auto_context_tokens)
+        return Benchmark.from_sample(path, config)
+
+    # Module imports and sample loads are independent, so load them in parallel (map keeps walk order)
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        benchmarks: list[Benchmark] = [
+            benchmark
+            for benchmark in executor.map(_load_one, entries)
+            if len(user_benchmarks) == 0 or benchmark_listed(benchmark.title, user_benchmarks)
+        ]
     print("Found benchmarks:\n" + "\n".join(b.title for b in benchmarks))
     print("*" * 80)
 
     # Run benchmarks
     results_cache = dir_path / f"benchmark_results_cache_{uuid4()}.jsonl"
     results_cache.touch()
-    total_cost = 0.0
-    for i, benchmark in enumerate(benchmarks):
-        if max_benchmarks and i >= max_benchmarks:
-            break
-        # Run benchmark.run() with timeout
+    if max_benchmarks:
+        benchmarks = benchmarks[:max_benchmarks]
+    # The cache is only for crash recovery; results are summarized from memory
+    all_results: list[BenchmarkResult] = []
+    with open(results_cache, "a", buffering=1 << 20) as f:
         try:
-            result = asyncio.run(benchmark.run(retries=retries))
-            with open(results_cache, "a") as f:
-                for r in result:
-                    total_cost += r.cost if r.cost else 0.0
-                    f.write(r.to_json() + "\n")
+            asyncio.run(_run_benchmarks_concurrently(benchmarks, retries, max_workers, f, all_results))
         except KeyboardInterrupt:
             # TODO: Prints none on first ctrl+c, then here - probably the PythonClient
             print("Exiting...")
-            break
-        except Exception as e:
-            print(f"Error running benchmark {benchmark.title}: {e}")
-            continue
 
     # Summarize results
+    total_cost = sum(r.cost if r.cost else 0.0 for r in all_results)
     print(f"Total cost: {total_cost}")
-    with open(results_cache, "r") as f:
-        results = [BenchmarkResult.load_json(line) for line in f.readlines()]
     benchmark_run = BenchmarkRun(
-        results,
+        all_results,
         metadata={
             "type": "Sampled",
             "date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
@@ -350,4 +548,5 @@ if __name__ == "__main__":
         args.retries,
         args.max_benchmarks,
         args.auto_context_tokens,
+        args.max_workers,
     )
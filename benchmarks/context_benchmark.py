@@ -62,6 +62,7 @@ def main(user_samples: list[str], directory: str):
     print(f"Running benchmarks from {dir_path}")
     samples: list[Sample] = []
     for root, dirs, files in os.walk(dir_path):
+        dirs[:] = [d for d in dirs if not d.startswith(".") and d not in {"__pycache__", "node_modules"}]
         for file in files:
             path = Path(root) / file
             if file.endswith(".json"):
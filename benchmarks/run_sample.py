@@ -28,6 +28,8 @@ def setup_sample(
         commit=setup_commit,
         diff_merge_base=sample.diff_merge_base,
         diff_active=sample.diff_active,
+        # SWE-Bench samples checkout merge_base after the environment setup below
+        required_commits=[sample.merge_base] if sample.environment_setup_commit and sample.merge_base else None,
     )
     cwd = Path(repo.working_dir)
 
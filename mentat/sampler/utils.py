@@ -1,4 +1,5 @@
 import os
+import re
 from pathlib import Path
 from typing import Optional
 from uuid import uuid4
@@ -10,6 +11,7 @@ from mentat.git_handler import get_non_gitignored_files
 from mentat.utils import is_file_text_encoded
 
 CLONE_TO_DIR = Path("benchmarks/benchmark_repos")
+_COMMIT_SHA_RE = re.compile(r"[0-9a-f]{7,40}")
 
 
 def clone_repo(url: str, local_dir_name: str, refresh: bool = False, depth: int = 0) -> Path | None:
@@ -31,23 +33,37 @@ def clone_repo(url: str, local_dir_name: str, refresh: bool = False, depth: int
 def apply_diff_to_repo(diff: str, repo: Repo, commit: bool = False) -> str | None:
     """Apply a git diff to a repo. If commit is True, commit the changes."""
     temp_id = uuid4().hex
+    # Git commands run in the repo's working dir, so don't depend on the process cwd
+    diff_path = Path(repo.working_dir) / f".sample_{temp_id}.diff"
     try:
         # Save self.diff_merge_base to a temporary .diff file
-        with open(f".sample_{temp_id}.diff", "w") as f:
+        with open(diff_path, "w") as f:
             f.write(diff)
-        repo.git.execute(["git", "apply", f".sample_{temp_id}.diff"])
-        os.remove(f".sample_{temp_id}.diff")
+        repo.git.execute(["git", "apply", str(diff_path)])
+        os.remove(diff_path)
         if commit:
             repo.git.add(".")
             repo.git.commit("-m", f"sample_{temp_id}")
     except GitCommandError as e:
         try:
-            os.remove(f".sample_{temp_id}.diff")
+            os.remove(diff_path)
         except FileNotFoundError:
             pass
         return str(e)
 
 
+def has_local_commit(repo: Repo, commit: str) -> bool:
+    """Returns True if commit is a sha that is already present in the local object store."""
+    if not _COMMIT_SHA_RE.fullmatch(commit):
+        # Branch and tag names may have moved upstream, so they always need a fetch
+        return False
+    try:
+        repo.git.cat_file("-e", f"{commit}^{{commit}}")
+        return True
+    except GitCommandError:
+        return False
+
+
 def setup_repo(
     url: str,
     cwd: Path | str | None = None,
@@ -55,7 +71,15 @@ def setup_repo(
     commit: Optional[str] = None,
     diff_merge_base: Optional[str] = None,
     diff_active: Optional[str] = None,
+    chdir: bool = True,
+    required_commits: Optional[list[str]] = None,
 ) -> Repo:
+    """Checkout commit (and apply any diffs) in a clone of url, cloning it if cwd is None.
+
+    Unless chdir is False, the process cwd is changed to the repo, since a Mentat session
+    run there afterwards expects it. required_commits lists any other commits the caller
+    will use afterwards, so the fetch is only skipped when all of them are already local.
+    """
     # Locate or clone repo
     repo_name = url.split("/")[-1]
     if cwd is None:
@@ -71,13 +95,17 @@ def setup_repo(
         cwd = Path(cwd)
         if not cwd.exists():
             raise SampleError(f"Error: {cwd} does not exist")
-    os.chdir(cwd)
 
     # Setup git history
-    repo = Repo(".")
+    repo = Repo(cwd)
+    if chdir:
+        os.chdir(repo.working_dir)
     repo.git.reset("--hard")
     repo.git.clean("-fd")
-    repo.git.fetch("--all")
+    # Samples sharing a clone usually target commits that an earlier sample already fetched
+    needed_commits = [commit, *(required_commits or [])]
+    if not all(c is not None and has_local_commit(repo, c) for c in needed_commits):
+        repo.git.fetch("--all")
     if commit is not None:
         repo.git.checkout(commit)
     if diff_merge_base:
@@ -107,7 +135,7 @@ def get_active_snapshot_commit(repo: Repo) -> str | None:
     try:
         # Stash active changes and record the current position
         for file in get_non_gitignored_files(Path(repo.working_dir)):
-            if is_file_text_encoded(file):
+            if is_file_text_encoded(Path(repo.working_dir) / file):
                 repo.git.add(file)
         repo.git.stash("push", "-u")
         detached_head = repo.head.is_detached
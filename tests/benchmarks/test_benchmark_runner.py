@@ -5,7 +5,9 @@ from unittest.mock import patch
 
 import pytest
 
-from benchmarks.benchmark_runner import run_benchmarks
+from benchmarks.benchmark_result import BenchmarkResult
+from benchmarks.benchmark_runner import Benchmark, grade, grade_diff, run_benchmarks
+from mentat.session_context import SESSION_CONTEXT
 
 
 @pytest.fixture
@@ -76,16 +78,15 @@ def test_run_real_world_benchmark(mock_webbrowser, mock_call_llm_api):
             dedent(
                 """\
             {
-                "indentation": false,
-                "off_by_one": false,
-                "syntax": false
-            }"""
-            ),
-            dedent(
-                """\
-            {
-                "referenced_format": true,
-                "trailing_waffling": false
+                "diff": {
+                    "indentation": false,
+                    "off_by_one": false,
+                    "syntax": false
+                },
+                "response": {
+                    "referenced_format": true,
+                    "trailing_waffling": false
+                }
             }"""
             ),
         ]
@@ -99,3 +100,91 @@ def test_run_real_world_benchmark(mock_webbrowser, mock_call_llm_api):
         summary = json.load(f)
     summary = summary["summary"]
     assert summary["cost"] == [0, 1]
+
+
+@pytest.mark.asyncio
+async def test_grade_diff_skips_empty_diff(mock_call_llm_api):
+    mock_call_llm_api.set_return_values([])
+    result = await grade_diff("\n", "Some response", BenchmarkResult(name="test"), "human diff")
+    assert mock_call_llm_api.call_count == 0
+    assert result.code == "\n"
+    assert result.diff_grade is None
+    assert result.response_grade is None
+    assert result.comparison_grade is None
+
+
+@pytest.mark.asyncio
+async def test_grade_diff_skips_empty_response(mock_call_llm_api):
+    mock_call_llm_api.set_return_values(['{"diff": {"off_by_one": true, "indentation": false, "syntax": false}}'])
+    result = await grade_diff("some diff", "  ", BenchmarkResult(name="test"))
+    assert mock_call_llm_api.call_count == 1
+    messages = mock_call_llm_api.call_args[0][0]
+    assert "=== MODEL RESPONSE ===" not in messages[1]["content"]
+    assert "=== DIFF ===\nsome diff" in messages[1]["content"]
+    assert result.off_by_one is True
+    assert result.response_grade == {}
+    assert result.referenced_format is None
+
+
+@pytest.mark.asyncio
+async def test_grade_diff_missing_sections(mock_call_llm_api):
+    mock_call_llm_api.set_return_values(['{"diff": {"syntax": true}, "response": "not an object"}'])
+    result = await grade_diff("some diff", "Some response", BenchmarkResult(name="test"), "human diff")
+    assert result.syntax_error is True
+    assert "error" in result.response_grade
+    assert result.referenced_format is None
+    assert "error" in result.comparison_grade
+    assert result.missing_functionality is None
+    assert result.extra_functionality is None
+
+
+@pytest.mark.asyncio
+async def test_grade_diff_invalid_json(mock_call_llm_api):
+    mock_call_llm_api.set_return_values(["not json"])
+    result = await grade_diff("some diff", "Some response", BenchmarkResult(name="test"), "human diff")
+    # The parse error from grade() is propagated to every section
+    error = result.diff_grade["error"]
+    assert error
+    assert result.response_grade == {"error": error}
+    assert result.comparison_grade == {"error": error}
+    assert result.off_by_one is None
+    assert result.referenced_format is None
+
+
+
+@pytest.mark.asyncio
+async def test_grade_truncates_prompt_one_token_over(mock_call_llm_api):
+    mock_call_llm_api.set_return_values(["{}"])
+    spice = SESSION_CONTEXT.get().llm_api_handler.spice
+    to_grade = "x" * 100
+    with patch("benchmarks.benchmark_runner._max_grade_tokens", return_value=10):
+        with patch.object(spice, "count_prompt_tokens", return_value=11):
+            assert await grade(to_grade, "prompt") == {}
+    # Removing a fraction of a token must still drop something, without emptying the message
+    content = mock_call_llm_api.call_args[0][0][1]["content"]
+    assert 0 < len(content) < len(to_grade)
+
+def test_from_module_copies_cached_config(tmp_path):
+    module_path = tmp_path / "benchmark.py"
+    module_path.write_text(
+        dedent(
+            """\
+            from mentat.config import Config
+
+            title = "Test Benchmark"
+            description = ""
+            prompts = ["Do something"]
+            repo = "https://github.com/AbanteAI/mentat"
+            commit = "HEAD"
+            config = Config(maximum_context=8000)"""
+        )
+    )
+    first = Benchmark.from_module(module_path, "benchmark")
+    first.config.maximum_context = 100
+    first.config.file_exclude_glob_list.append("*.txt")
+
+    second = Benchmark.from_module(module_path, "benchmark")
+    assert second.config is not first.config
+    assert second.config.maximum_context == 8000
+    assert second.config.file_exclude_glob_list == []
+    assert second.config.parser is first.config.parser
@@ -21,7 +21,7 @@ from mentat.parsers.parser import ParsedLLMResponse
 from mentat.sampler import __version__
 from mentat.sampler.sample import Sample
 from mentat.sampler.sampler import Sampler
-from mentat.sampler.utils import get_active_snapshot_commit
+from mentat.sampler.utils import get_active_snapshot_commit, has_local_commit, setup_repo
 from mentat.session import Session
 
 
@@ -435,3 +435,40 @@ async def test_sampler_integration(temp_testbed, mock_session_context, mock_call
     result = await run_sample(sample, temp_testbed)
     diff_eval = result["diff_eval"]
     assert diff_eval == sample.diff_edit
+
+
+def test_has_local_commit(temp_testbed):
+    repo = Repo(temp_testbed)
+    hexsha = repo.head.commit.hexsha
+    assert has_local_commit(repo, hexsha)
+    assert has_local_commit(repo, hexsha[:7])
+    assert not has_local_commit(repo, "0" * 40)
+    # Branch names always need a fetch
+    assert not has_local_commit(repo, repo.active_branch.name)
+
+
+def test_setup_repo_fetches_missing_required_commits(temp_testbed, tmp_path):
+    upstream = Repo(temp_testbed)
+    old_commit = upstream.head.commit.hexsha
+    clone = Repo.clone_from(temp_testbed, tmp_path / "clone")
+
+    # A commit made upstream after cloning, like a new benchmark's comparison_commit
+    with open(temp_testbed / "new_file.py", "w") as f:
+        f.write("new")
+    upstream.git.add("new_file.py")
+    upstream.git.commit("-m", "new upstream commit")
+    new_commit = upstream.head.commit.hexsha
+    assert not has_local_commit(clone, new_commit)
+
+    # commit is already local, so only the required commit can trigger the fetch
+    setup_repo(url=str(temp_testbed), cwd=clone.working_dir, commit=old_commit, chdir=False)
+    assert not has_local_commit(clone, new_commit)
+    setup_repo(
+        url=str(temp_testbed),
+        cwd=clone.working_dir,
+        commit=old_commit,
+        chdir=False,
+        required_commits=[new_commit],
+    )
+    assert has_local_commit(clone, new_commit)
+    assert clone.head.commit.hexsha == old_commit